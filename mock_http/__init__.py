@@ -17,19 +17,32 @@
 """Build a mock HTTP server that really works to unit test web service-dependent programs."""
 
 #import BaseHTTPServer
+import atexit
 from collections import defaultdict
 import copy
+import errno
+import itertools
+import json
+import os
+import random
 import select
+import shutil
 import socket
+import ssl
+import struct
+import subprocess
+import tempfile
 import time
 import threading
+import zlib
 
-from cherrypy.wsgiserver import CherryPyWSGIServer
+from cherrypy.wsgiserver import CherryPyWSGIServer, HTTPConnection,\
+     HTTPRequest
 from cherrypy._cptree import Tree
 from cherrypy import request, response
 
 __all__ = ['GET', 'POST', 'PUT', 'DELETE', 'never', 'once', 'at_least_once',
-           'MockHTTP']
+           'MockHTTP', 'MockHTTPPool', 'tls_ca_path', 'CONTROL_PATH']
 
 GET = 'GET'
 POST = 'POST'
@@ -40,11 +53,169 @@ never = object()
 once = object()
 at_least_once = object()
 
-def _server_thread(server, finished_serving):
-    """Handle requests to our server in another thread."""
-    server.start()
+# Where a MockHTTP created with control=True takes changes to its expectations.
+CONTROL_PATH = '/__mock__/expectations'
+
+# How :meth:`MockHTTP.load` spells the times sentinels.
+_TIMES = {'never': never, 'once': once, 'at_least_once': at_least_once}
+
+# Accept-Encoding values remembered per Expectation before starting afresh, so
+# a long-running server can't be grown without bound by odd clients.
+_MAX_ENCODING_CHOICES = 64
+
+# Content-codings Expectation.will(compress=...) knows how to produce, in the
+# order they're preferred when a client accepts several equally.
+_ENCODERS = {
+    'gzip': lambda body: _zlib_compress(body, 16 + zlib.MAX_WBITS),
+    'deflate': lambda body: _zlib_compress(body, zlib.MAX_WBITS),
+}
+_DEFAULT_ENCODINGS = ('gzip', 'deflate')
+
+# Faults Expectation.will(fault=...) can inject. Those that cut the body short
+# are carried out once the headers and half of the body have been sent.
+_FAULTS = ('reset', 'truncate', 'stall', 'trickle')
+_BODY_FAULTS = ('reset', 'truncate', 'stall')
+
+# How often, in seconds, a stalled response checks whether to give up.
+_STALL_POLL = 0.1
+
+# Formats Expectation.will(stream=...) can frame events in, with the
+# Content-Type each is sent as.
+_STREAM_CONTENT_TYPES = {
+    None: None,
+    'sse': 'text/event-stream',
+    'ndjson': 'application/x-ndjson',
+}
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and \
+           not isinstance(value, bool)
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _sse_event(event):
+    """Frame an event as a server-sent event. Dictionaries may give its
+    "event", "id" and "retry" fields as well as its "data"."""
+    lines = []
+    if isinstance(event, dict):
+        for field in ('event', 'id', 'retry'):
+            if field in event:
+                lines.append('%s: %s' % (field, _utf8(event[field])))
+        event = event.get('data', '')
+    lines.extend('data: ' + line for line in _utf8(event).split('\n'))
+    return '\n'.join(lines) + '\n\n'
+
+def _ndjson_event(event):
+    return json.dumps(event) + '\n'
+
+_STREAM_FRAMERS = {
+    None: _utf8,
+    'sse': _sse_event,
+    'ndjson': _ndjson_event,
+}
+
+def _load_kwargs(spec):
+    """Turn a dictionary read from JSON into keyword arguments."""
+    kwargs = dict((str(key), value) for key, value in spec.iteritems())
+    if isinstance(kwargs.get('body'), unicode):
+        kwargs['body'] = _utf8(kwargs['body'])
+    return kwargs
+
+def _zlib_compress(body, wbits):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, wbits)
+    return compressor.compress(body) + compressor.flush()
+
+def _parse_accept_encoding(accept_encoding):
+    """Map each content-coding in an Accept-Encoding header to its q-value."""
+    qualities = {}
+    for item in accept_encoding.split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+# Timestamps handed to hooks. Pythons without a monotonic clock fall back to
+# the wall clock.
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# Not every Python exposes this constant, but every OpenSSL honours it.
+_OP_NO_TICKET = getattr(ssl, 'OP_NO_TICKET', 0x00004000)
+
+_tls_lock = threading.Lock()
+_tls_cache = {}
+
+def _server_thread(server, finished_serving, errors):
+    """Handle requests to our server in another thread. Anything that stops
+    it, such as its port being taken, is put in `errors` for MockHTTP."""
+    try:
+        server.start()
+    except Exception, e:
+        errors.append(e)
     finished_serving.set()
 
+def _generate_certificate(cert_path, key_path):
+    """Write a self-signed certificate for localhost and its private key.
+    It's thrown away with the process, so is valid for long enough that even
+    a server left running for months never sees it expire."""
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-nodes', '-days', '3650',
+             '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+             '-subj', '/CN=localhost',
+             '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+             '-keyout', key_path, '-out', cert_path],
+            stdout=devnull, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError), e:
+        raise MockHTTPException('Could not generate a TLS certificate: %s' % e)
+    finally:
+        devnull.close()
+
+def _tls_context():
+    """Return the process-wide SSLContext used by TLS MockHTTP servers.
+    
+    The certificate and context are built on first use and shared by every
+    server afterwards. Sharing the context also shares its session cache and
+    ticket keys, so clients can resume sessions across MockHTTP instances."""
+    _tls_lock.acquire()
+    try:
+        if 'context' not in _tls_cache:
+            directory = tempfile.mkdtemp(prefix='mock_http-')
+            atexit.register(shutil.rmtree, directory, True)
+            cert_path = os.path.join(directory, 'cert.pem')
+            key_path = os.path.join(directory, 'key.pem')
+            _generate_certificate(cert_path, key_path)
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+            context.options &= ~_OP_NO_TICKET
+            context.load_cert_chain(cert_path, key_path)
+            _tls_cache['ca_path'] = cert_path
+            _tls_cache['context'] = context
+        return _tls_cache['context']
+    finally:
+        _tls_lock.release()
+
+def tls_ca_path():
+    """The path to the PEM certificate served by TLS MockHTTP servers.
+    
+    The certificate is self-signed, so it doubles as the CA file clients
+    should trust, e.g. ``httplib2.Http(ca_certs=tls_ca_path())``."""
+    _tls_context()
+    return _tls_cache['ca_path']
+
 class MockHTTPException(Exception):
     """Raised when something unexpected goes wrong in MockHTTP's guts."""
     pass
@@ -90,6 +261,115 @@ class WrongParamValueException(MockHTTPExpectationFailure):
     """Raised when MockHTTP got a request with an invalid param value."""
     pass
 
+class _Trickle(object):
+    """Wraps a file object to send whatever's written to it a byte at a time."""
+    def __init__(self, wfile, delay, stopping):
+        self.wfile = wfile
+        self.delay = delay
+        self.stopping = stopping
+    
+    def sendall(self, data):
+        for byte in data:
+            self.wfile.sendall(byte)
+            if self.stopping.wait(self.delay):
+                raise socket.error(errno.ECONNRESET, 'Server stopping')
+
+class _MockHTTPRequest(HTTPRequest):
+    """An HTTPRequest that injects whatever fault an Expectation asks for.
+    
+    Expectations reach it through the WSGI environ, at 'mock_http.request',
+    and set :attr:`fault`, :attr:`fault_delay`, :attr:`stall_timeout` and
+    :attr:`stopping`."""
+    fault = None
+    fault_delay = None
+    stall_timeout = None
+    stopping = None
+    writing = False
+    
+    def respond(self):
+        self.environ['mock_http.request'] = self
+        HTTPRequest.respond(self)
+    
+    def send_headers(self):
+        if self.fault == 'trickle':
+            wfile = self.wfile
+            self.wfile = _Trickle(wfile, self.fault_delay, self.stopping)
+            try:
+                HTTPRequest.send_headers(self)
+            finally:
+                self.wfile = wfile
+        else:
+            HTTPRequest.send_headers(self)
+        if self.fault in _BODY_FAULTS and not self.writing:
+            # There's no body to cut short.
+            self._fail()
+    
+    def write(self, chunk):
+        if self.fault in _BODY_FAULTS:
+            self.writing = True
+            HTTPRequest.write(self, chunk[:len(chunk) // 2])
+            self._fail()
+        HTTPRequest.write(self, chunk)
+    
+    def _fail(self):
+        if self.fault == 'stall':
+            self._stall()
+        elif self.fault == 'reset':
+            # Closing with a zero linger time sends RST rather than FIN.
+            self.wfile._sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                        struct.pack('ii', 1, 0))
+        self.close_connection = True
+        # HTTPConnection hangs up quietly on this, as if the client had.
+        raise socket.error(errno.ECONNRESET,
+                           'Injected fault: %s' % self.fault)
+    
+    def _stall(self):
+        """Send nothing until the client hangs up, the stall times out or the
+        server stops, so stalls can't hold on to the server's threads."""
+        sock = self.wfile._sock
+        deadline = _monotonic() + self.stall_timeout
+        while not self.stopping.is_set():
+            remaining = deadline - _monotonic()
+            if remaining <= 0:
+                return
+            # A client waiting on a response sends nothing, so anything it
+            # does send, such as a FIN or a TLS close_notify, is it hanging up.
+            readable, _, _ = select.select([sock], [], [],
+                                           min(remaining, _STALL_POLL))
+            if readable:
+                return
+
+class _HTTPConnection(HTTPConnection):
+    """An HTTPConnection whose requests can inject faults."""
+    RequestHandlerClass = _MockHTTPRequest
+
+class _WSGIServer(CherryPyWSGIServer):
+    """A CherryPyWSGIServer whose requests can inject faults."""
+    ConnectionClass = _HTTPConnection
+
+class _TLSHTTPConnection(_HTTPConnection):
+    """An HTTPConnection that speaks TLS using the shared SSLContext."""
+    def __init__(self, sock, wsgi_app, environ):
+        # The handshake happens on first read, in the worker thread, so a slow
+        # or broken client can't stall the accept loop.
+        sock = _tls_context().wrap_socket(sock, server_side=True,
+                                          do_handshake_on_connect=False)
+        _HTTPConnection.__init__(self, sock, wsgi_app, environ)
+    
+    def communicate(self):
+        try:
+            _HTTPConnection.communicate(self)
+        except (ssl.SSLError, socket.error):
+            # Failed handshakes, clients that hang up mid-record and
+            # connections closed by MockHTTP.reset only end their own
+            # connection; they mustn't take the worker thread down.
+            pass
+
+class _TLSWSGIServer(_WSGIServer):
+    """A CherryPyWSGIServer serving HTTPS with the shared SSLContext."""
+    ConnectionClass = _TLSHTTPConnection
+    environ = {'wsgi.url_scheme': 'https', 'HTTPS': 'on'}
+
 class Expectation(object):
     """A request that a MockHTTP server is expecting. Don't construct these
     directly, use :meth:`MockHTTP.expects`"""
@@ -105,18 +385,30 @@ class Expectation(object):
         self.response_code = 200
         self.response_headers = {}
         self.response_body = ''
+        self.compress = ()
+        self.response_variants = {}
+        self._encoding_choices = {}
+        self.stream = None
+        self.stream_format = None
+        self.stream_delays = None
+        self.stream_count = None
+        self.fault = None
+        self.fault_rate = 1.0
+        self.fault_delay = 0.01
+        self.stall_timeout = 60.0
         self.times = times
         self.invoked = False
+        self.hits = 0
         self.failure = None
         self.name = name
-        if name is not None:
-            self.mock.expected_by_name[name] = self
-        if after is not None:
-            self.after = self.mock.expected_by_name[after]
-        else:
-            self.after = None
+        # Resolved to the named Expectation when this one is declared.
+        self.after_name = after
+        self.after = None
     
-    def will(self, http_code=None, headers=None, body=None):
+    def will(self, http_code=None, headers=None, body=None, compress=None,
+             stream=None, stream_format=None, rate=None, schedule=None,
+             count=None, fault=None, fault_rate=None, fault_delay=None,
+             stall_timeout=None):
         """Specifies what to do in response to a matching request.
         
         :param http_code: The HTTP code to send. *Default:* 200 OK.
@@ -125,15 +417,191 @@ class Expectation(object):
         :param body: A string object containing the HTTP body to send. To send\
         unicode, first encode it to utf-8. (And probably include an appropriate\
         content-type header.) *Default:* No body is sent.
-        :returns: This :class:`Expectation` object."""
+        :param compress: Content-codings the body may be sent with, chosen per\
+        request from the client's Accept-Encoding header. Either a sequence of\
+        'gzip' and 'deflate', in order of preference, or True for both. The\
+        compressed bodies are computed once, here, not for every request.\
+        *Default:* The body is always sent as-is.
+        :param stream: Send a stream of events, as they're produced, instead\
+        of the body, holding the connection open until the stream ends. Either\
+        a callable returning an iterable of events, such as a generator\
+        function, called afresh for each request; a list of events; or a\
+        string template, formatted with the event number as ``%(n)d``, to\
+        send forever. Streams are sent uncompressed and occupy one of the\
+        server's threads each. *Default:* The body is sent.
+        :param stream_format: How to frame each event: 'sse' for server-sent\
+        events, from strings or dictionaries of "event", "id", "retry" and\
+        "data"; 'ndjson' for lines of JSON; or None to send each as-is.\
+        Sets the Content-Type, unless headers does. *Default:* None.
+        :param rate: Send this many events per second, which must be more\
+        than 0. *Default:* As fast as they're produced.
+        :param schedule: Instead of a rate, a sequence of how many seconds to\
+        wait before each event, repeated for as long as the stream lasts. It\
+        can't be empty, or wait a negative time.
+        :param count: Stop the stream after this many events. *Default:* Send\
+        every event the stream produces. Giving stream_format, rate, schedule\
+        or count without stream is a ValueError.
+        :param fault: Misbehave at the connection level: 'reset' sends half\
+        of the body then resets the connection; 'truncate' sends half of the\
+        body then closes the connection, short of the Content-Length;\
+        'stall' sends half of the body then sends nothing more until the\
+        client hangs up, stall_timeout passes or the server is closed down,\
+        then closes the connection; 'trickle' sends the headers a byte at a time.\
+        Give a sequence of these to pick one at random for each request.\
+        *Default:* No faults.
+        :param fault_rate: The chance, from 0 to 1, that any one request\
+        suffers the fault. *Default:* 1, every request.
+        :param fault_delay: Seconds between the bytes of a 'trickle'.\
+        *Default:* 0.01.
+        :param stall_timeout: The most seconds a 'stall' lasts.\
+        *Default:* 60.
+        :returns: This :class:`Expectation` object.
+        :raises ValueError: If an argument is of the wrong type or out of\
+        range, so it couldn't be honoured when a request came."""
         if http_code is not None:
+            if not (isinstance(http_code, (int, long)) and
+                    100 <= http_code <= 999):
+                raise ValueError('http_code must be a number from 100 to 999, '
+                                 'not %r' % (http_code,))
             self.response_code = http_code
         if body is not None:
             self.response_body = body
         if headers is not None:
             self.response_headers = headers
+        if compress is not None:
+            if compress is True:
+                compress = _DEFAULT_ENCODINGS
+            elif not compress:
+                compress = ()
+            for encoding in compress:
+                if encoding not in _ENCODERS:
+                    raise ValueError('Unsupported content-coding: %r' % encoding)
+            self.compress = tuple(compress)
+        if self.compress and (body is not None or compress is not None):
+            self._prepare_variants()
+        if stream is not None:
+            if not (callable(stream) or isinstance(stream, basestring)):
+                try:
+                    iter(stream)
+                except TypeError:
+                    raise ValueError('stream must be a callable, a list of '
+                                     'events or a template, not %r' % stream)
+            if stream_format is not None and \
+               not isinstance(stream_format, basestring) or \
+               stream_format not in _STREAM_FRAMERS:
+                raise ValueError('Unknown stream_format: %r' % (stream_format,))
+            if rate is not None and schedule is not None:
+                raise ValueError('Give a rate or a schedule, not both')
+            if rate is not None and not (_is_number(rate) and rate > 0):
+                raise ValueError('rate must be positive, not %r' % (rate,))
+            if schedule is not None:
+                try:
+                    delays = list(schedule)
+                except TypeError:
+                    delays = []
+                if isinstance(schedule, basestring) or not delays or \
+                   not all(_is_number(delay) and delay >= 0
+                           for delay in delays):
+                    raise ValueError('schedule must be a sequence of seconds '
+                                     'to wait, none negative, not %r' %
+                                     (schedule,))
+                schedule = delays
+            if count is not None and \
+               not (isinstance(count, (int, long)) and count >= 0):
+                raise ValueError('count must be a number of events, not %r' %
+                                 (count,))
+            self.stream = stream
+            self.stream_format = stream_format
+            if rate is not None:
+                self.stream_delays = [1.0 / rate]
+            else:
+                self.stream_delays = schedule
+            self.stream_count = count
+        elif any(option is not None
+                 for option in (stream_format, rate, schedule, count)):
+            raise ValueError('stream_format, rate, schedule and count only '
+                             'apply to a stream')
+        if fault is not None:
+            if isinstance(fault, basestring):
+                fault = (fault,)
+            for name in fault:
+                if name not in _FAULTS:
+                    raise ValueError('Unknown fault: %r' % name)
+            self.fault = tuple(fault)
+        if fault_rate is not None:
+            if not (_is_number(fault_rate) and 0 <= fault_rate <= 1):
+                raise ValueError('fault_rate must be a number from 0 to 1, '
+                                 'not %r' % (fault_rate,))
+            self.fault_rate = fault_rate
+        for name, seconds in (('fault_delay', fault_delay),
+                              ('stall_timeout', stall_timeout)):
+            if seconds is not None and \
+               not (_is_number(seconds) and seconds >= 0):
+                raise ValueError('%s must be a number of seconds, not %r' %
+                                 (name, seconds))
+        if fault_delay is not None:
+            self.fault_delay = fault_delay
+        if stall_timeout is not None:
+            self.stall_timeout = stall_timeout
         return self
     
+    def _stream_events(self):
+        """Produce the framed events of a stream, at its rate or schedule."""
+        if callable(self.stream):
+            events = self.stream()
+        elif isinstance(self.stream, basestring):
+            events = (self.stream % {'n': n} for n in itertools.count())
+        else:
+            events = iter(self.stream)
+        if self.stream_count is not None:
+            events = itertools.islice(events, self.stream_count)
+        frame = _STREAM_FRAMERS[self.stream_format]
+        if not self.stream_delays:
+            for event in events:
+                if self.mock.finish_serving.is_set():
+                    return
+                yield frame(event)
+            return
+        # Keep to the schedule even when sending an event takes a while.
+        due = _monotonic()
+        for event, delay in itertools.izip(
+                events, itertools.cycle(self.stream_delays)):
+            due += delay
+            # Waiting on finish_serving ends streams when the server stops.
+            if self.mock.finish_serving.wait(max(due - _monotonic(), 0)):
+                return
+            yield frame(event)
+    
+    def _prepare_variants(self):
+        """Precompute the response body for each content-coding we offer."""
+        self.response_variants = {None: self.response_body}
+        for encoding in self.compress:
+            self.response_variants[encoding] = \
+                _ENCODERS[encoding](self.response_body)
+        self._encoding_choices = {}
+    
+    def _choose_encoding(self, accept_encoding):
+        """Pick the content-coding to send for an Accept-Encoding header.
+        
+        Clients send few distinct Accept-Encoding values, so the choice is
+        remembered per value rather than renegotiated on every request.
+        
+        :returns: The chosen content-coding, or None to send the body as-is."""
+        try:
+            return self._encoding_choices[accept_encoding]
+        except KeyError:
+            pass
+        if len(self._encoding_choices) >= _MAX_ENCODING_CHOICES:
+            self._encoding_choices = {}
+        qualities = _parse_accept_encoding(accept_encoding)
+        chosen, chosen_quality = None, 0.0
+        for encoding in self.compress:
+            quality = qualities.get(encoding, qualities.get('*', 0.0))
+            if quality > chosen_quality:
+                chosen, chosen_quality = encoding, quality
+        self._encoding_choices[accept_encoding] = chosen
+        return chosen
+    
     def check(self, method, path, params, headers, body):
         """Check this Expectation against the given request."""
         try:
@@ -199,7 +667,37 @@ class Expectation(object):
         for header, value in self.response_headers.iteritems():
             response.headers[header] = value
         self.invoked = True
-        return self.response_body
+        self.mock.lock.acquire()
+        try:
+            self.hits += 1
+        finally:
+            self.mock.lock.release()
+        if self.fault and random.random() < self.fault_rate:
+            server_request = request.wsgi_environ['mock_http.request']
+            server_request.fault = random.choice(self.fault)
+            server_request.fault_delay = self.fault_delay
+            server_request.stall_timeout = self.stall_timeout
+            server_request.stopping = self.mock.finish_serving
+        if self.stream is not None:
+            content_type = _STREAM_CONTENT_TYPES[self.stream_format]
+            if content_type is not None and \
+               'content-type' not in [header.lower()
+                                      for header in self.response_headers]:
+                response.headers['Content-Type'] = content_type
+            if self.stream_format == 'sse':
+                response.headers['Cache-Control'] = 'no-cache'
+            response.stream = True
+            return self._stream_events()
+        if not self.compress:
+            return self.response_body
+        encoding = self._choose_encoding(
+            request.headers.get('Accept-Encoding', ''))
+        body = self.response_variants[encoding]
+        response.headers['Vary'] = 'Accept-Encoding'
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Content-Length'] = str(len(body))
+        return body
 
 class MockHTTP(object):
     """A Mock HTTP Server for unit testing web services calls.
@@ -211,28 +709,127 @@ class MockHTTP(object):
          mock_server.expects(GET, '/asdf').will(http_code=404)
          urlopen('http://localhost:42424/index.html').read() == 'A HTML body.'
          urlopen('http://localhost:42424/asdf') # HTTPError: 404
-         mock_server.verify()"""
+         mock_server.verify()
+    
+    HTTPS Usage::
     
-    def __init__(self, port):
-        """Create a MockHTTP server listening on localhost at the given port."""
+         mock_server = MockHTTP(42424, tls=True)
+         http = httplib2.Http(ca_certs=mock_server.ca_path)
+         http.request('https://localhost:42424/index.html')"""
+    
+    def __init__(self, port, tls=False, threads=1, control=False):
+        """Create a MockHTTP server listening on localhost at the given port.
+        
+        :param port: The port to listen on. Pass 0 to let the OS pick a free\
+        port; the one it picked is available as :attr:`port`.
+        :param tls: Serve HTTPS instead of HTTP, using a self-signed\
+        certificate for localhost. The certificate is generated once per\
+        process; its path is available as :attr:`ca_path`. *Default:* False.
+        :param threads: How many requests to serve at once. *Default:* 1.
+        :param control: Accept changes to expectations from other processes,\
+        at :data:`CONTROL_PATH`. GET it for :meth:`status`; POST a JSON list of\
+        operations to :meth:`apply` them. *Default:* False.
+        :raises MockHTTPException: If the server can't start, such as when\
+        its port is already taken."""
         self.server_address = ('localhost', port)
+        self.control = control
+        self.lock = threading.Lock()
+        # Held while expectations change; requests being served never take it.
+        self.update_lock = threading.Lock()
         self.finish_serving = threading.Event()
         self.finished_serving = threading.Event()
         tree = Tree()
         mock_root = MockRoot(self)
         tree.mount(mock_root, '/')
-        self.server = CherryPyWSGIServer(
-            self.server_address, tree, server_name='localhost', numthreads=1)
+        if tls:
+            # Builds the shared context here, so failures surface in the caller.
+            self.ca_path = tls_ca_path()
+            self.scheme = 'https'
+            server_class = _TLSWSGIServer
+        else:
+            self.scheme = 'http'
+            self.ca_path = None
+            server_class = _WSGIServer
+        self.server = server_class(
+            self.server_address, tree, server_name='localhost',
+            numthreads=threads)
+        errors = []
         self.thread = threading.Thread(
             target=_server_thread, kwargs={'server': self.server,
-                                           'finished_serving': self.finished_serving})
+                                           'finished_serving': self.finished_serving,
+                                           'errors': errors})
         self.thread.start()
         while not self.server.ready:
+            if self.finished_serving.is_set():
+                self.thread.join()
+                raise MockHTTPException('Could not serve on port %s: %s' %
+                                        (port, errors and errors[0]))
             time.sleep(0.1)
+        self.port = self.server.socket.getsockname()[1]
+        self.server_address = ('localhost', self.port)
+        self.server.bind_addr = self.server_address
+        self.reset()
+    
+    def add_hook(self, hook):
+        """Calls ``hook(phase, timestamp, method, path)`` as each request
+        passes through these phases:
+        
+        * "received": CherryPy started on the request.
+        * "start": CherryPy has parsed and dispatched the request to MockHTTP.
+        * "match": The request's :class:`Expectation` has been found.
+        * "check": The Expectation's checks have passed.
+        * "respond": The response is ready. Requests that fail go straight\
+          here from the phase they failed in.
+        
+        Timestamps are in seconds, from a monotonic clock where Python has\
+        one. Hooks are called from the threads serving requests, so must be\
+        thread-safe. :meth:`reset` removes them. Without any hooks, requests\
+        pay nothing for them. See\
+        :class:`mock_http.profiling.RequestProfiler` for a ready-made hook."""
+        self.hooks = self.hooks + [hook]
+    
+    def remove_hook(self, hook):
+        """Stops calling a hook added with :meth:`add_hook`."""
+        hooks = list(self.hooks)
+        hooks.remove(hook)
+        self.hooks = hooks
+    
+    def _fire(self, phase, method, path, timestamp=None):
+        if timestamp is None:
+            timestamp = _monotonic()
+        for hook in self.hooks:
+            hook(phase, timestamp, method, path)
+    
+    def url(self, path):
+        """The absolute URL for a path on this server."""
+        return '%s://localhost:%d%s' % (self.scheme, self.port, path)
+    
+    def reset(self):
+        """Forget all expectations, hooks and failures, leaving the server
+        running so it can be reused. Connections that clients have kept alive
+        are closed, so they can't tie up the server's threads for whoever uses
+        it next."""
         self.last_failure = None
+        self.hooks = []
         self.expected = defaultdict(dict)
         self.expected_by_name = {}
+        self.request_count = 0
+        self.failure_count = 0
+        self._close_connections()
     
+    def _close_connections(self):
+        for worker in list(self.server.requests._threads):
+            connection = worker.conn
+            if connection is None:
+                continue
+            try:
+                # Like CherryPyWSGIServer.stop: the worker's blocked read ends,
+                # and it closes the connection itself.
+                connection.socket._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                # It was closed while we looked.
+                pass
+
     def expects(self, method, path, *args, **kwargs):
         """Declares an HTTP Request that this MockHTTP expects.
         
@@ -261,19 +858,181 @@ class MockHTTP(object):
         to describe how the URL should be responded to.
         """
         expectation = Expectation(self, method, path, *args, **kwargs)
-        self.expected[method][path] = expectation
+        self.update_lock.acquire()
+        try:
+            return self._declare(self.expected, self.expected_by_name,
+                                 expectation)
+        finally:
+            self.update_lock.release()
+    
+    def _declare(self, expected, expected_by_name, expectation):
+        if expectation.after_name is not None:
+            expectation.after = expected_by_name[expectation.after_name]
+        if expectation.name is not None:
+            expected_by_name[expectation.name] = expectation
+        expected[expectation.method][expectation.path] = expectation
         return expectation
     
-    def verify(self):
+    def _forget(self, expected, expected_by_name, method, path):
+        expectation = expected[method].pop(path)
+        if expected_by_name.get(expectation.name) is expectation:
+            del expected_by_name[expectation.name]
+    
+    def apply(self, operations):
+        """Changes this MockHTTP's expectations as one batch, atomically:
+        requests see either none of the batch or all of it, and go on being\
+        served while it's applied. Each operation is a dictionary, such as\
+        those read from JSON, with an "op" of:
+        
+        * "add": Declares an expectation, described as for :meth:`load`.
+        * "replace": Like "add", but replaces the expectation for the same\
+          method and path. Expectations declared to come after the old one\
+          come after its replacement instead.
+        * "remove": Removes the expectation for a "method" and "path", so\
+          long as no other expectation comes after it.
+        
+        :raises ValueError: If any operation can't be applied, in which case\
+        none are.
+        :returns: A list of the :class:`Expectation` objects declared."""
+        self.update_lock.acquire()
+        try:
+            expected = defaultdict(dict)
+            for method, paths in self.expected.iteritems():
+                expected[method] = dict(paths)
+            expected_by_name = dict(self.expected_by_name)
+            declared = []
+            forgotten = False
+            for operation in operations:
+                if not isinstance(operation, dict):
+                    raise ValueError('Expected an operation, got: %r' %
+                                     (operation,))
+                kwargs = _load_kwargs(operation)
+                op = kwargs.pop('op', None)
+                if not isinstance(op, basestring) or \
+                   op not in ('add', 'replace', 'remove'):
+                    raise ValueError('Unknown op: %r' % (op,))
+                try:
+                    method, path = kwargs['method'], kwargs['path']
+                except KeyError, e:
+                    raise ValueError('%s needs a %s' % (op, e))
+                if not isinstance(method, basestring) or \
+                   not isinstance(path, basestring):
+                    raise ValueError('%s needs a method and path that are '
+                                     'strings, not %r and %r' %
+                                     (op, method, path))
+                exists = path in expected.get(method, {})
+                if op == 'add' and exists:
+                    raise ValueError("Can't add %s %s: already expected" %
+                                     (method, path))
+                if op != 'add' and not exists:
+                    raise ValueError("Can't %s %s %s: not expected" %
+                                     (op, method, path))
+                if exists:
+                    self._forget(expected, expected_by_name, method, path)
+                    forgotten = True
+                if op != 'remove':
+                    expectation = self._expectation(kwargs)
+                    try:
+                        self._declare(expected, expected_by_name, expectation)
+                    except KeyError, e:
+                        raise ValueError('No expectation named %s' % e)
+                    declared.append(expectation)
+            if forgotten:
+                for expectation, after in self._successors(expected):
+                    expectation.after = after
+            self.expected, self.expected_by_name = expected, expected_by_name
+            return declared
+        finally:
+            self.update_lock.release()
+    
+    def _successors(self, expected):
+        """Find the expectations whose `after` was replaced or removed.
+        
+        :raises ValueError: If one was removed.
+        :returns: A list of pairs of each such expectation and the one that\
+        replaced its `after`."""
+        successors = []
+        for paths in expected.values():
+            for expectation in paths.values():
+                after = expectation.after
+                if after is None:
+                    continue
+                successor = expected.get(after.method, {}).get(after.path)
+                if successor is None:
+                    raise ValueError("Can't remove %s %s: %s %s expects it "
+                                     "first" % (after.method, after.path,
+                                                expectation.method,
+                                                expectation.path))
+                if successor is not after:
+                    successors.append((expectation, successor))
+        return successors
+    
+    def _expectation(self, kwargs):
+        """Build an Expectation from keyword arguments read from JSON."""
+        will = kwargs.pop('response', None) or {}
+        if not isinstance(will, dict):
+            raise ValueError('Expected a response dictionary, got: %r' %
+                             (will,))
+        will = _load_kwargs(will)
+        # Caught here, these would otherwise only fail once a request came.
+        for arguments, argument, kind in (
+                (kwargs, 'params', dict), (kwargs, 'headers', dict),
+                (kwargs, 'name', basestring), (kwargs, 'after', basestring),
+                (will, 'headers', dict), (will, 'body', basestring)):
+            value = arguments.get(argument)
+            if value is not None and not isinstance(value, kind):
+                raise ValueError('Wrong type for %s: %r' % (argument, value))
+        if kwargs.get('times') is not None:
+            try:
+                kwargs['times'] = _TIMES[kwargs['times']]
+            except (KeyError, TypeError):
+                raise ValueError('Unknown times: %r' % (kwargs['times'],))
+        try:
+            return Expectation(self, **kwargs).will(**will)
+        except TypeError, e:
+            raise ValueError(str(e))
+    
+    def load(self, specs):
+        """Declares HTTP Requests described as dictionaries, such as those read
+        from a JSON fixture file::
+        
+             [{"method": "GET", "path": "/index.html", "times": "once",
+               "response": {"http_code": 200, "body": "A HTML body."}}]
+        
+        Each dictionary takes the arguments of :meth:`expects`, with `times`\
+        spelled as "never", "once" or "at_least_once", and an optional\
+        "response" dictionary of arguments to :meth:`Expectation.will`.\
+        Unicode bodies are encoded as utf-8. The expectations are declared\
+        atomically, as by :meth:`apply`.
+        
+        :raises ValueError: If any expectation can't be declared, in which\
+        case none are.
+        :returns: A list of the :class:`Expectation` objects declared."""
+        operations = []
+        for spec in specs:
+            if not isinstance(spec, dict):
+                raise ValueError('Expected a dictionary, got: %r' % (spec,))
+            operations.append(dict(spec, op='add'))
+        return self.apply(operations)
+    
+    def stop(self):
+        """Close down the server."""
+        self.finish_serving.set()
+        self.server.stop()
+        self.finished_serving.wait()
+        self.thread.join()
+    
+    def verify(self, stop=True):
         """Close down the server and verify that this MockHTTP has met all its
         expectations.
         
+        :param stop: Whether to close down the server first. Pass False to\
+        verify a server that will be :meth:`reset` and reused. *Default:* True.
         :returns: True, if all went as expected.
         :raises MockHTTPExpectationFailure: Or a subclass, describing the last\
         unexpected thing that happened."""
-        self.server.stop()
-        self.finished_serving.wait()
-        self.thread.join()
+        if stop:
+            self.stop()
         if self.last_failure is not None:
             raise self.last_failure
         for method, expected in self.expected.iteritems():
@@ -284,6 +1043,29 @@ class MockHTTP(object):
                     raise UnretrievedURLException("%s not %s" % (path, method))
         return True
     
+    def status(self):
+        """Describe how this MockHTTP is living up to its expectations so far,
+        without closing down the server.
+        
+        :returns: A dictionary, suitable for dumping as JSON, with whether the\
+        server would pass :meth:`verify` now, why not, how many requests it\
+        has served and failed, and how often each expectation was met."""
+        try:
+            self.verify(stop=False)
+            failure = None
+        except MockHTTPExpectationFailure, e:
+            failure = '%s: %s' % (e.__class__.__name__, e)
+        expectations = []
+        for method, expected in self.expected.items():
+            for path, expectation in expected.items():
+                expectations.append({'method': method, 'path': path,
+                                     'name': expectation.name,
+                                     'hits': expectation.hits})
+        return {'verified': failure is None, 'failure': failure,
+                'requests': self.request_count,
+                'failures': self.failure_count,
+                'expectations': expectations}
+    
     def is_expected(self, method, path, params, headers, body):
         """Test to see whether a request is expected.
         
@@ -293,16 +1075,112 @@ class MockHTTP(object):
         :raises MockHTTPExpectationFailure: Or a subclass, describing why this\
         request is unexpected.
         :returns: The :class:`Expectation` object that expects this request."""
+        self.lock.acquire()
         try:
-            if path not in self.expected[method]:
+            self.request_count += 1
+        finally:
+            self.lock.release()
+        try:
+            # Look up once: apply() may swap in new expectations at any time.
+            expectation = self.expected.get(method, {}).get(path)
+            if expectation is None:
                 raise UnexpectedURLException('Unexpected URL: %s' % path)
-            expectation = self.expected[method][path]
+            if self.hooks:
+                self._fire('match', method, path)
             if expectation.check(method, path, params, headers, body):
+                if self.hooks:
+                    self._fire('check', method, path)
                 return expectation
         except MockHTTPExpectationFailure, failure:
+            self.lock.acquire()
+            try:
+                self.failure_count += 1
+            finally:
+                self.lock.release()
             self.last_failure = failure
             raise
 
+class MockHTTPPool(object):
+    """A pool of running :class:`MockHTTP` servers on ephemeral ports.
+    
+    Starting and stopping a server takes far longer than most tests that use
+    one, so a pool hands out servers that are already running and takes them
+    back afterwards instead::
+    
+         pool = MockHTTPPool(size=2)
+         mock_server = pool.acquire()
+         mock_server.expects(GET, '/index.html').will(body='A HTML body.')
+         urlopen(mock_server.url('/index.html')).read() == 'A HTML body.'
+         pool.release(mock_server) # Verifies, then resets for the next user.
+         pool.close()"""
+    
+    def __init__(self, size=0, tls=False):
+        """Create a pool, starting `size` servers straight away.
+        
+        :param size: How many servers to start up front. The pool starts more\
+        as they're needed. *Default:* 0.
+        :param tls: Whether the pool's servers serve HTTPS. *Default:* False."""
+        self.tls = tls
+        self.lock = threading.Lock()
+        self.servers = []
+        self.idle = []
+        for i in xrange(size):
+            self.idle.append(self._start())
+    
+    def _start(self):
+        mock = MockHTTP(0, tls=self.tls)
+        self.lock.acquire()
+        try:
+            self.servers.append(mock)
+        finally:
+            self.lock.release()
+        return mock
+    
+    def acquire(self):
+        """Take a running server with no expectations out of the pool."""
+        self.lock.acquire()
+        try:
+            if self.idle:
+                return self.idle.pop()
+        finally:
+            self.lock.release()
+        return self._start()
+    
+    def release(self, mock, verify=True):
+        """Return a server to the pool.
+        
+        :param verify: Whether to verify the server's expectations before\
+        resetting it. *Default:* True.
+        :returns: True, if all went as expected.
+        :raises MockHTTPExpectationFailure: Or a subclass, from\
+        :meth:`MockHTTP.verify`. The server is returned to the pool anyway."""
+        try:
+            if verify:
+                return mock.verify(stop=False)
+            return True
+        finally:
+            mock.reset()
+            self.lock.acquire()
+            try:
+                if mock.finished_serving.is_set():
+                    # Someone stopped it themselves; don't hand it out again.
+                    self.servers.remove(mock)
+                else:
+                    self.idle.append(mock)
+            finally:
+                self.lock.release()
+    
+    def close(self):
+        """Close down every server the pool has started."""
+        self.lock.acquire()
+        try:
+            servers, self.servers, self.idle = self.servers, [], []
+        finally:
+            self.lock.release()
+        for mock in servers:
+            if not mock.finished_serving.is_set():
+                mock.stop()
+
 def mock_fail(mock, path, message=None):
     """Standardized mechanism for reporting failure."""
     mock.failed_url = path
@@ -315,15 +1193,46 @@ class MockRoot(object):
     
     def default(self, *args, **params):
         path = '/' + '/'.join(args)
+        hooks = self.mock.hooks
+        if hooks:
+            now = _monotonic()
+            # CherryPy only notes the wall clock time it started at.
+            self.mock._fire('received', request.method, path,
+                            now - (time.time() - response.time))
+            self.mock._fire('start', request.method, path, now)
         try:
             if request.body:
                 body = request.body.read()
             else:
                 body = ''
+            if self.mock.control and path == CONTROL_PATH:
+                return self._control(request.method, body)
             return self.mock.is_expected(request.method, path, params,
                                          request.headers, body).respond()
         except MockHTTPException, failure:
             return mock_fail(self.mock, path, failure)
         except MockHTTPExpectationFailure, failure:
             return mock_fail(self.mock, path, failure)
+        finally:
+            # Even when the request blows up, so hooks never miss its end.
+            if hooks:
+                self.mock._fire('respond', request.method, path)
     default.exposed = True
+    
+    def _control(self, method, body):
+        """Serve :data:`CONTROL_PATH`."""
+        response.headers['Content-Type'] = 'application/json'
+        if method == POST:
+            try:
+                operations = json.loads(body)
+                if not isinstance(operations, list):
+                    raise ValueError('Expected a JSON list of operations')
+                self.mock.apply(operations)
+            except ValueError, e:
+                response.status = 400
+                return json.dumps({'error': str(e)})
+        elif method != GET:
+            response.status = 405
+            response.headers['Allow'] = 'GET, POST'
+            return json.dumps({'error': 'Method not allowed: %s' % method})
+        return json.dumps(self.mock.status())
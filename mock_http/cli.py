@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# Copyright 2010 O'Reilly Media, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Run a :class:`mock_http.MockHTTP` as a standalone stand-in service.
+
+Usage::
+
+     mock-http serve fixtures.json --port 42424 --threads 10
+
+The fixture file is a JSON list of expectations, in the form taken by
+:meth:`mock_http.MockHTTP.load`. The server runs until it gets SIGINT or
+SIGTERM, then verifies its expectations and exits with status 0 if they were
+met or 1 if they weren't. It exits straight away with status 2 if the
+fixture can't be loaded, or 3 if the server can't start, such as when its
+port is taken. SIGUSR1 dumps :meth:`mock_http.MockHTTP.status` as JSON
+without stopping the server.
+
+With ``--control``, other processes can GET that status from, and POST batches
+of changes to the expectations to, :data:`mock_http.CONTROL_PATH`."""
+
+import argparse
+import json
+import signal
+import sys
+import time
+
+from mock_http import MockHTTP, MockHTTPException
+
+def _dump_status(status, status_file):
+    status = json.dumps(status, indent=2, sort_keys=True)
+    if status_file is None:
+        sys.stderr.write(status + '\n')
+        sys.stderr.flush()
+    else:
+        out = open(status_file, 'w')
+        try:
+            out.write(status + '\n')
+        finally:
+            out.close()
+
+def _load_failed(fixture, error):
+    sys.stderr.write("Can't load %s: %s\n" % (fixture, error))
+    sys.stderr.flush()
+    return 2
+
+def serve(fixture, port, threads=10, tls=False, control=False,
+          status_file=None):
+    """Serve the expectations in a fixture file until told to stop.
+
+    :returns: 0 if the expectations were met, 1 if not, 2 if the fixture\
+    couldn't be loaded, or 3 if the server couldn't start."""
+    try:
+        fixture_file = open(fixture)
+        try:
+            specs = json.load(fixture_file)
+        finally:
+            fixture_file.close()
+        if not isinstance(specs, list):
+            raise ValueError('Expected a JSON list of expectations')
+    except (IOError, ValueError), e:
+        return _load_failed(fixture, e)
+    try:
+        mock = MockHTTP(port, tls=tls, threads=threads, control=control)
+    except MockHTTPException, e:
+        sys.stderr.write('%s\n' % e)
+        sys.stderr.flush()
+        return 3
+    try:
+        mock.load(specs)
+    except ValueError, e:
+        # The server's thread would otherwise keep us running.
+        mock.stop()
+        return _load_failed(fixture, e)
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+    def dump(signum, frame):
+        _dump_status(mock.status(), status_file)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGUSR1, dump)
+    sys.stderr.write('Serving %s on %s\n' % (fixture, mock.url('/')))
+    if mock.ca_path is not None:
+        sys.stderr.write('CA certificate: %s\n' % mock.ca_path)
+    sys.stderr.flush()
+    while not stopping:
+        time.sleep(1)
+    mock.stop()
+    status = mock.status()
+    _dump_status(status, status_file)
+    if status['verified']:
+        return 0
+    return 1
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='mock-http', description='A mock HTTP server.')
+    commands = parser.add_subparsers(dest='command')
+    serve_parser = commands.add_parser(
+        'serve', help='Serve the expectations in a JSON fixture file.')
+    serve_parser.add_argument('fixture', help='The JSON fixture file.')
+    serve_parser.add_argument(
+        '--port', type=int, default=0,
+        help='The port to listen on. (default: one picked by the OS)')
+    serve_parser.add_argument(
+        '--threads', type=int, default=10,
+        help='How many requests to serve at once. (default: 10)')
+    serve_parser.add_argument(
+        '--tls', action='store_true',
+        help='Serve HTTPS with a self-signed certificate for localhost.')
+    serve_parser.add_argument(
+        '--control', action='store_true',
+        help='Accept changes to the expectations over HTTP.')
+    serve_parser.add_argument(
+        '--status-file',
+        help='Write status dumps here instead of to stderr.')
+    args = parser.parse_args(argv)
+    return serve(args.fixture, args.port, threads=args.threads, tls=args.tls,
+                 control=args.control, status_file=args.status_file)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# Copyright 2010 O'Reilly Media, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Find out where a :class:`mock_http.MockHTTP` spends its time."""
+
+import cProfile
+import pstats
+import threading
+
+# The phases RequestProfiler times, each measured from the phase before it.
+PHASES = ('start', 'match', 'check', 'respond')
+
+class RequestProfiler(object):
+    """A hook for :meth:`mock_http.MockHTTP.add_hook` that totals the time
+    requests spend in each phase, and can run cProfile over a window of
+    requests::
+        
+         profiler = RequestProfiler(every=10)
+         mock_server.add_hook(profiler)
+         profiler.profile(100, 'mock_http.pstats')
+         # ... make requests ...
+         profiler.summary()['match']['mean']
+    
+    Each phase is timed from the end of the one before it, so "start" is the
+    time CherryPy took to parse and dispatch the request, "match" the time to
+    read its body and find its expectation, "check" the time taken by the
+    expectation's checks and "respond" the time to build the response. "total"
+    runs from "received" to "respond"."""
+    
+    def __init__(self, every=1):
+        """Create a profiler.
+        
+        :param every: Time only every this many requests. *Default:* Time\
+        every request."""
+        self.every = every
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.seen = 0
+        self.timings = dict((phase, [0, 0.0, 0.0])
+                            for phase in PHASES + ('total',))
+        self.profile_remaining = 0
+        self.profile_running = 0
+        self.profile_path = None
+        self.profiles = []
+    
+    def __call__(self, phase, timestamp, method, path):
+        local = self.local
+        if phase == 'received':
+            self.lock.acquire()
+            try:
+                sampled = self.seen % self.every == 0
+                self.seen += 1
+                profiling = self.profile_remaining > 0
+                if profiling:
+                    self.profile_remaining -= 1
+                    self.profile_running += 1
+            finally:
+                self.lock.release()
+            local.received = local.last = timestamp if sampled else None
+            local.profile = None
+            if profiling:
+                local.profile = cProfile.Profile()
+                local.profile.enable()
+            return
+        if getattr(local, 'last', None) is not None:
+            self._record(phase, timestamp - local.last)
+            local.last = timestamp
+            if phase == 'respond':
+                self._record('total', timestamp - local.received)
+        if phase == 'respond' and getattr(local, 'profile', None) is not None:
+            local.profile.disable()
+            self._profiled(local.profile)
+            local.profile = None
+    
+    def _record(self, phase, elapsed):
+        self.lock.acquire()
+        try:
+            timing = self.timings[phase]
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+        finally:
+            self.lock.release()
+    
+    def _profiled(self, profile):
+        self.lock.acquire()
+        try:
+            self.profiles.append(profile)
+            self.profile_running -= 1
+            if self.profile_remaining or self.profile_running:
+                return
+            profiles, self.profiles = self.profiles, []
+            path, self.profile_path = self.profile_path, None
+        finally:
+            self.lock.release()
+        pstats.Stats(*profiles).dump_stats(path)
+    
+    def profile(self, requests, path):
+        """Run cProfile over the next few requests, then write the combined
+        results to a file for :mod:`pstats`. Profiling begins once MockHTTP
+        has the request, so doesn't cover CherryPy's parsing.
+        
+        :param requests: How many requests to profile.
+        :param path: Where to write the results."""
+        self.lock.acquire()
+        try:
+            self.profile_remaining = requests
+            self.profile_path = path
+            self.profiles = []
+        finally:
+            self.lock.release()
+    
+    def summary(self):
+        """The timings so far.
+        
+        :returns: A dictionary mapping each phase, and "total", to a\
+        dictionary of the "count" of requests timed, and the "total", "mean"\
+        and "max" seconds they spent in it."""
+        self.lock.acquire()
+        try:
+            timings = dict((phase, list(timing))
+                           for phase, timing in self.timings.iteritems())
+        finally:
+            self.lock.release()
+        summary = {}
+        for phase, (count, total, longest) in timings.iteritems():
+            summary[phase] = {'count': count, 'total': total, 'max': longest,
+                              'mean': total / count if count else 0.0}
+        return summary
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Copyright 2010 O'Reilly Media, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""pytest fixtures handing each test a clean :class:`mock_http.MockHTTP`.
+
+Installing mock_http registers this plugin with pytest, so tests can just ask
+for a server::
+
+     def test_index(mock_http):
+         mock_http.expects(GET, '/index.html').will(body='A HTML body.')
+         urlopen(mock_http.url('/index.html')).read() == 'A HTML body.'
+
+The server is verified when the test finishes, so there's no need to call
+:meth:`mock_http.MockHTTP.verify` yourself. Servers come from a pool kept by
+each pytest process and listen on ports the OS picks, so they're safe to use
+with pytest-xdist: every worker has a pool of its own, and no two servers ever
+contend for a port."""
+
+import pytest
+
+from mock_http import MockHTTPPool
+
+def pytest_addoption(parser):
+    parser.addini('mock_http_pool_size',
+                  'Number of MockHTTP servers each pytest process starts '
+                  'before its first test asks for one. (default: 1)',
+                  default='1')
+
+def _pool(request, tls):
+    pool = MockHTTPPool(size=int(request.config.getini('mock_http_pool_size')),
+                        tls=tls)
+    request.addfinalizer(pool.close)
+    return pool
+
+@pytest.fixture(scope='session')
+def mock_http_pool(request):
+    """The :class:`mock_http.MockHTTPPool` of HTTP servers for this process."""
+    return _pool(request, tls=False)
+
+@pytest.fixture(scope='session')
+def mock_https_pool(request):
+    """The :class:`mock_http.MockHTTPPool` of HTTPS servers for this process."""
+    return _pool(request, tls=True)
+
+@pytest.fixture
+def mock_http(request, mock_http_pool):
+    """A running :class:`mock_http.MockHTTP` with no expectations, verified
+    when the test finishes."""
+    mock = mock_http_pool.acquire()
+    request.addfinalizer(lambda: mock_http_pool.release(mock))
+    return mock
+
+@pytest.fixture
+def mock_https(request, mock_https_pool):
+    """Like :func:`mock_http`, but serving HTTPS. Clients should trust
+    ``mock_https.ca_path``."""
+    mock = mock_https_pool.acquire()
+    request.addfinalizer(lambda: mock_https_pool.release(mock))
+    return mock
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# Copyright 2010 O'Reilly Media, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import httplib2
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock_http
+
+class TestCLI(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fixture = os.path.join(self.directory, 'fixture.json')
+        self.status_file = os.path.join(self.directory, 'status.json')
+        self.http = httplib2.Http()
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def _serve(self, specs, *args):
+        """Start mock-http serve on a fixture, in a process of its own so it
+        can be sent signals. Pass None for specs to serve a missing fixture."""
+        if specs is not None:
+            fixture_file = open(self.fixture, 'w')
+            try:
+                json.dump(specs, fixture_file)
+            finally:
+                fixture_file.close()
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [os.path.dirname(os.path.dirname(mock_http.__file__))] +
+            os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+        return subprocess.Popen(
+            [sys.executable, '-m', 'mock_http.cli', 'serve', self.fixture,
+             '--status-file', self.status_file] + list(args),
+            stderr=subprocess.PIPE, env=env)
+    
+    def _url(self, process):
+        """Read the URL a server is serving on from what it prints."""
+        while True:
+            line = process.stderr.readline()
+            if not line:
+                self.fail('mock-http serve exited early')
+            if line.startswith('Serving '):
+                return line.split()[-1]
+    
+    def _wait(self, process, timeout=20):
+        deadline = time.time() + timeout
+        while process.poll() is None:
+            if time.time() > deadline:
+                process.kill()
+                process.wait()
+                self.fail('mock-http serve still running after %ss' % timeout)
+            time.sleep(0.1)
+        return process.returncode
+    
+    def _status(self):
+        status_file = open(self.status_file)
+        try:
+            return json.load(status_file)
+        finally:
+            status_file.close()
+    
+    def test_serve(self):
+        """Tests serving a fixture until SIGTERM."""
+        process = self._serve([{'method': 'GET', 'path': '/index.html',
+                                'times': 'once',
+                                'response': {'body': 'A HTML body.'}}])
+        url = self._url(process)
+        resp, content = self.http.request(uri = url + 'index.html',
+                                          method = 'GET')
+        self.assertEqual(content, 'A HTML body.')
+        process.send_signal(signal.SIGTERM)
+        self.assertEqual(self._wait(process), 0)
+        status = self._status()
+        self.assert_(status['verified'])
+        self.assertEqual(status['requests'], 1)
+    
+    def test_serve_unmet_expectation(self):
+        """Tests that a server whose expectations weren't met exits with 1."""
+        process = self._serve([{'method': 'GET', 'path': '/index.html',
+                                'times': 'once'}])
+        self._url(process)
+        process.send_signal(signal.SIGUSR1)
+        deadline = time.time() + 20
+        while not (os.path.exists(self.status_file) and
+                   os.path.getsize(self.status_file)) and \
+              time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(self._status()['requests'], 0)
+        os.remove(self.status_file)
+        process.send_signal(signal.SIGTERM)
+        self.assertEqual(self._wait(process), 1)
+        status = self._status()
+        self.assertFalse(status['verified'])
+        self.assertEqual(status['failure'],
+                         'UnretrievedURLException: /index.html not GET')
+    
+    def test_serve_bad_fixture(self):
+        """Tests that a fixture that can't be loaded exits straight away."""
+        process = self._serve([{'method': 'GET', 'path': '/index.html',
+                                'times': 'twice'}])
+        self.assertEqual(self._wait(process), 2)
+        self.assert_("Unknown times: u'twice'" in process.stderr.read())
+        self.assertFalse(os.path.exists(self.status_file))
+    
+    def test_serve_missing_fixture(self):
+        """Tests that a fixture that isn't there exits straight away."""
+        process = self._serve(None)
+        self.assertEqual(self._wait(process), 2)
+        self.assert_("Can't load %s" % self.fixture in process.stderr.read())
+    
+    def test_serve_port_taken(self):
+        """Tests that a port that's already taken exits straight away."""
+        taken = socket.socket()
+        try:
+            taken.bind(('localhost', 0))
+            taken.listen(1)
+            process = self._serve([], '--port', str(taken.getsockname()[1]))
+            self.assertEqual(self._wait(process), 3)
+            self.assert_('Could not serve on port' in process.stderr.read())
+        finally:
+            taken.close()
@@ -13,13 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import httplib
 import logging
+import socket
 from unittest import TestCase
 import httplib2
-from mock_http import MockHTTP, GET, POST, UnexpectedURLException,\
+from mock_http import MockHTTP, MockHTTPPool, GET, POST, UnexpectedURLException,\
      UnretrievedURLException, URLOrderingException, WrongBodyException,\
      AlreadyRetrievedURLException, WrongHeaderValueException,\
-     WrongHeaderException, never, once, at_least_once
+     WrongHeaderException, never, once, at_least_once, tls_ca_path,\
+     CONTROL_PATH, MockHTTPException
+from mock_http.profiling import RequestProfiler
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import time
 from random import randint
 import sys
 
@@ -42,6 +52,14 @@ class TestMockHTTP(TestCase):
         self.assertEqual(resp['status'], '200')
         self.assert_(mock.verify())
     
+    def test_port_taken(self):
+        """Tests that a server whose port is taken says so, not hangs."""
+        mock = MockHTTP(self.server_port)
+        try:
+            self.assertRaises(MockHTTPException, MockHTTP, self.server_port)
+        finally:
+            mock.stop()
+    
     def test_get_request_wrong_url(self):
         """Tests a get request that expects a different URL."""
         mock = MockHTTP(self.server_port)
@@ -267,3 +285,486 @@ class TestMockHTTP(TestCase):
             method = 'POST', body = test_body, headers=test_headers)
         self.assertEqual(resp['status'], '404')
         self.assertRaises(WrongHeaderValueException, mock.verify)
+
+    def test_get_request_tls(self):
+        """Tests a get request over HTTPS."""
+        test_body = 'Test response.'
+        mock = MockHTTP(self.server_port, tls=True)
+        mock.expects(method=GET, path='/index.html').will(body=test_body)
+        http = httplib2.Http(ca_certs=mock.ca_path)
+        resp, content = http.request(
+            uri = 'https://localhost:%s/index.html' % self.server_port,
+            method = 'GET')
+        self.assertEqual(resp['status'], '200')
+        self.assertEqual(content, test_body)
+        self.assert_(mock.verify())
+    
+    def test_tls_certificate_is_shared(self):
+        """Tests that TLS servers reuse one certificate per process."""
+        mock = MockHTTP(self.server_port, tls=True)
+        self.assertEqual(mock.scheme, 'https')
+        self.assertEqual(mock.ca_path, tls_ca_path())
+        self.assert_(mock.verify())
+
+    def test_get_compressed(self):
+        """Tests a get request for a body the client accepts gzipped."""
+        test_body = 'Test response. ' * 100
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/index.html').will(
+            body=test_body, compress=True)
+        resp, content = self.http.request(
+            uri = 'http://localhost:%s/index.html' % self.server_port,
+            method = 'GET', headers = {'accept-encoding': 'gzip, deflate'})
+        self.assertEqual(resp['-content-encoding'], 'gzip')
+        self.assertEqual(resp['vary'], 'Accept-Encoding')
+        self.assertEqual(content, test_body)
+        self.assert_(mock.verify())
+    
+    def test_get_compressed_not_accepted(self):
+        """Tests a compressible body for a client that doesn't accept it."""
+        test_body = 'Test response. ' * 100
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/index.html').will(
+            body=test_body, compress=['deflate'])
+        resp, content = self.http.request(
+            uri = 'http://localhost:%s/index.html' % self.server_port,
+            method = 'GET', headers = {'accept-encoding': 'gzip, deflate;q=0'})
+        self.assert_('-content-encoding' not in resp)
+        self.assertEqual(resp['content-length'], str(len(test_body)))
+        self.assertEqual(content, test_body)
+        self.assert_(mock.verify())
+
+    def test_load(self):
+        """Tests expectations declared from JSON-style dictionaries."""
+        mock = MockHTTP(self.server_port)
+        mock.load([{u'method': u'GET', u'path': u'/index.html',
+                    u'times': u'once',
+                    u'response': {u'http_code': 201, u'body': u'caf\xe9'}}])
+        resp, content = self.http.request(
+            uri = 'http://localhost:%s/index.html' % self.server_port,
+            method = 'GET')
+        self.assertEqual(resp['status'], '201')
+        self.assertEqual(content, 'caf\xc3\xa9')
+        self.assert_(mock.verify())
+    
+    def test_status(self):
+        """Tests reporting on expectations while the server is running."""
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/index.html', times=once)
+        self.assertEqual(mock.status()['failure'],
+                         'UnretrievedURLException: /index.html not GET')
+        for i in range(2):
+            resp, content = self.http.request(
+                uri = 'http://localhost:%s/index.html' % self.server_port,
+                method = 'GET')
+        status = mock.status()
+        self.assertFalse(status['verified'])
+        self.assertEqual(status['requests'], 2)
+        self.assertEqual(status['failures'], 1)
+        self.assertEqual(status['expectations'][0]['hits'], 1)
+        self.assertRaises(AlreadyRetrievedURLException, mock.verify)
+
+    def test_apply(self):
+        """Tests changing expectations as a batch."""
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/old.html', name='old')
+        mock.expects(method=GET, path='/index.html')
+        mock.apply([
+            {'op': 'remove', 'method': GET, 'path': '/old.html'},
+            {'op': 'replace', 'method': GET, 'path': '/index.html',
+             'response': {'body': 'Replaced.'}},
+            {'op': 'add', 'method': POST, 'path': '/index.html'}])
+        self.assertEqual(mock.expected_by_name, {})
+        resp, content = self.http.request(
+            uri = 'http://localhost:%s/index.html' % self.server_port,
+            method = 'GET')
+        self.assertEqual(content, 'Replaced.')
+        self.assert_(mock.verify())
+    
+    def test_apply_is_atomic(self):
+        """Tests that a batch with a bad operation changes nothing."""
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/index.html')
+        self.assertRaises(ValueError, mock.apply, [
+            {'op': 'remove', 'method': GET, 'path': '/index.html'},
+            {'op': 'add', 'method': GET, 'path': '/new.html', 'after': 'nope'}])
+        self.assertEqual(mock.expected[GET].keys(), ['/index.html'])
+        self.assert_(mock.verify())
+    
+    def test_apply_replace_after(self):
+        """Tests that replacing an expectation others come after keeps
+        them in order behind its replacement."""
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/login', name='login')
+        mock.expects(method=GET, path='/data', after='login')
+        mock.apply([{'op': 'replace', 'method': GET, 'path': '/login',
+                     'name': 'login', 'response': {'body': 'Welcome.'}}])
+        self.assert_(mock.expected[GET]['/data'].after is
+                     mock.expected[GET]['/login'])
+        for path in ('/login', '/data'):
+            resp, content = self.http.request(
+                uri = 'http://localhost:%s%s' % (self.server_port, path),
+                method = 'GET')
+            self.assertEqual(resp['status'], '200')
+        self.assert_(mock.verify())
+    
+    def test_apply_remove_after(self):
+        """Tests that an expectation others come after can't be removed
+        from under them."""
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/login', name='login')
+        mock.expects(method=GET, path='/data', after='login')
+        self.assertRaises(ValueError, mock.apply, [
+            {'op': 'remove', 'method': GET, 'path': '/login'}])
+        mock.apply([{'op': 'remove', 'method': GET, 'path': '/data'},
+                    {'op': 'remove', 'method': GET, 'path': '/login'}])
+        self.assertEqual(mock.expected[GET], {})
+        self.assert_(mock.verify())
+    
+    def test_control(self):
+        """Tests changing expectations over HTTP."""
+        mock = MockHTTP(self.server_port, control=True)
+        control_url = 'http://localhost:%s%s' % (self.server_port, CONTROL_PATH)
+        resp, content = self.http.request(
+            uri = control_url, method = 'POST',
+            body = json.dumps([{'op': 'add', 'method': GET,
+                                'path': '/index.html', 'times': 'once'}]),
+            headers = {'content-type': 'application/json'})
+        self.assertEqual(resp['status'], '200')
+        self.assertFalse(json.loads(content)['verified'])
+        resp, content = self.http.request(
+            uri = control_url, method = 'POST', body = '[{"op": "frob"}]',
+            headers = {'content-type': 'application/json'})
+        self.assertEqual(resp['status'], '400')
+        resp, content = self.http.request(
+            uri = 'http://localhost:%s/index.html' % self.server_port,
+            method = 'GET')
+        self.assertEqual(resp['status'], '200')
+        resp, content = self.http.request(uri = control_url, method = 'GET')
+        self.assert_(json.loads(content)['verified'])
+        self.assert_(mock.verify())
+    
+    def test_control_bad_operations(self):
+        """Tests that batches that can't be applied are refused whole."""
+        mock = MockHTTP(self.server_port, control=True)
+        mock.expects(method=GET, path='/index.html')
+        control_url = 'http://localhost:%s%s' % (self.server_port, CONTROL_PATH)
+        good = {'op': 'add', 'method': GET, 'path': '/new.html'}
+        for bad in [{'op': 'add', 'method': GET, 'path': '/', 'times': ['a']},
+                    {'op': 'add', 'method': [GET], 'path': '/'},
+                    {'op': ['add'], 'method': GET, 'path': '/'},
+                    {'op': 'add', 'method': GET, 'path': '/',
+                     'response': {'stream': 'x', 'rate': 0}},
+                    {'op': 'add', 'method': GET, 'path': '/', 'response': 1},
+                    {'op': 'add', 'method': GET, 'path': '/', 'params': [1]},
+                    {'op': 'add', 'method': GET, 'path': '/', 'name': [1]},
+                    {'op': 'add', 'method': GET, 'path': '/',
+                     'response': {'http_code': 'abc'}},
+                    {'op': 'add', 'method': GET, 'path': '/',
+                     'response': {'stream': 5}},
+                    {'op': 'add', 'method': GET, 'path': '/',
+                     'response': {'fault': 'trickle', 'fault_delay': 'x'}},
+                    {'op': 'add', 'method': GET, 'path': '/',
+                     'response': {'fault': 'reset', 'fault_rate': '0.5'}},
+                    {'op': 'add', 'method': GET, 'path': '/',
+                     'response': {'fault': 'stall', 'stall_timeout': -1}},
+                    'add']:
+            resp, content = self.http.request(
+                uri = control_url, method = 'POST',
+                body = json.dumps([good, bad]),
+                headers = {'content-type': 'application/json'})
+            self.assertEqual(resp['status'], '400')
+            self.assert_('error' in json.loads(content))
+        self.assertEqual(mock.expected[GET].keys(), ['/index.html'])
+        self.assertEqual(mock.status()['failures'], 0)
+        self.assert_(mock.verify())
+
+    def test_hooks(self):
+        """Tests that hooks see each phase of a request, in order."""
+        phases = []
+        mock = MockHTTP(self.server_port)
+        mock.add_hook(lambda phase, timestamp, method, path:
+                      phases.append((phase, timestamp, method, path)))
+        mock.expects(method=GET, path='/index.html')
+        resp, content = self.http.request(
+            uri = 'http://localhost:%s/index.html' % self.server_port,
+            method = 'GET')
+        self.assertEqual([phase for phase, timestamp, method, path in phases],
+                         ['received', 'start', 'match', 'check', 'respond'])
+        timestamps = [timestamp for phase, timestamp, method, path in phases]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(phases[-1][2:], (GET, '/index.html'))
+        self.assert_(mock.verify())
+    
+    def test_profiler(self):
+        """Tests timing and profiling requests."""
+        directory = tempfile.mkdtemp()
+        try:
+            stats_path = os.path.join(directory, 'mock_http.pstats')
+            profiler = RequestProfiler(every=2)
+            profiler.profile(2, stats_path)
+            mock = MockHTTP(self.server_port)
+            mock.add_hook(profiler)
+            mock.expects(method=GET, path='/index.html')
+            for i in range(4):
+                resp, content = self.http.request(
+                    uri = 'http://localhost:%s/index.html' % self.server_port,
+                    method = 'GET')
+            self.assert_(mock.verify())
+            summary = profiler.summary()
+            self.assertEqual(summary['check']['count'], 2)
+            self.assertEqual(summary['total']['count'], 2)
+            self.assert_(summary['total']['max'] >= summary['respond']['max'])
+            stats = pstats.Stats(stats_path)
+            self.assert_(any(function[2] == 'is_expected'
+                             for function in stats.stats))
+        finally:
+            shutil.rmtree(directory)
+    
+    def test_profiler_request_error(self):
+        """Tests that a request that blows up still ends its profile."""
+        directory = tempfile.mkdtemp()
+        try:
+            stats_path = os.path.join(directory, 'mock_http.pstats')
+            profiler = RequestProfiler()
+            profiler.profile(1, stats_path)
+            mock = MockHTTP(self.server_port)
+            mock.add_hook(profiler)
+            # Params that aren't a dictionary break the check for them.
+            mock.expects(method=GET, path='/index.html', params=5)
+            resp, content = self.http.request(
+                uri = 'http://localhost:%s/index.html' % self.server_port,
+                method = 'GET')
+            self.assertEqual(resp['status'], '500')
+            mock.stop()
+            self.assertEqual(profiler.summary()['total']['count'], 1)
+            self.assertEqual(profiler.profile_running, 0)
+            self.assert_(os.path.exists(stats_path))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_stream_sse(self):
+        """Tests streaming server-sent events at a rate."""
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/events').will(
+            stream=[{'event': 'greeting', 'id': 1, 'data': 'Hello\nthere'},
+                    'Bye'],
+            stream_format='sse', rate=10)
+        started = time.time()
+        resp, content = self.http.request(
+            uri = 'http://localhost:%s/events' % self.server_port,
+            method = 'GET')
+        self.assert_(time.time() - started >= 0.2)
+        self.assertEqual(resp['content-type'], 'text/event-stream')
+        self.assertEqual(resp['transfer-encoding'], 'chunked')
+        self.assertEqual(content, 'event: greeting\nid: 1\n'
+                                  'data: Hello\ndata: there\n\n'
+                                  'data: Bye\n\n')
+        self.assert_(mock.verify())
+    
+    def test_stream_ndjson(self):
+        """Tests streaming lines of JSON from a generator."""
+        def events():
+            for n in range(3):
+                yield {'n': n}
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/events').will(
+            stream=events, stream_format='ndjson', count=2)
+        for i in range(2):
+            resp, content = self.http.request(
+                uri = 'http://localhost:%s/events' % self.server_port,
+                method = 'GET')
+            self.assertEqual(resp['content-type'], 'application/x-ndjson')
+            self.assertEqual(content, '{"n": 0}\n{"n": 1}\n')
+        self.assert_(mock.verify())
+    
+    def test_stream_bad_options(self):
+        """Tests that stream options that can't be honoured are refused."""
+        mock = MockHTTP(self.server_port)
+        expectation = mock.expects(method=GET, path='/events')
+        for options in [{'stream': 'x', 'rate': 0},
+                        {'stream': 'x', 'rate': -1},
+                        {'stream': 'x', 'rate': 'x'},
+                        {'stream': 'x', 'schedule': [0.1, -0.1]},
+                        {'stream': 'x', 'schedule': 'ab'},
+                        {'stream': 'x', 'schedule': []},
+                        {'stream': 'x', 'schedule': 0.1},
+                        {'stream': 'x', 'stream_format': ['sse']},
+                        {'stream': 5},
+                        {'stream': 'x', 'count': -1},
+                        {'rate': 10},
+                        {'stream_format': 'sse'},
+                        {'count': 2}]:
+            self.assertRaises(ValueError, expectation.will, **options)
+        self.assertEqual(expectation.stream, None)
+        self.assert_(mock.verify())
+
+    def _raw_get(self, path, timeout=None):
+        """GET a path with httplib, which reports connection faults as-is."""
+        connection = httplib.HTTPConnection('localhost', self.server_port,
+                                            timeout=timeout)
+        try:
+            connection.request('GET', path)
+            resp = connection.getresponse()
+            return resp, resp.read()
+        finally:
+            connection.close()
+    
+    def test_fault_bad_options(self):
+        """Tests that responses that couldn't be sent are refused."""
+        mock = MockHTTP(self.server_port)
+        expectation = mock.expects(method=GET, path='/index.html')
+        for options in [{'http_code': 'abc'}, {'http_code': 42},
+                        {'fault': 'reset', 'fault_rate': '0.5'},
+                        {'fault': 'reset', 'fault_rate': 2},
+                        {'fault': 'trickle', 'fault_delay': 'x'},
+                        {'fault': 'stall', 'stall_timeout': -1}]:
+            self.assertRaises(ValueError, expectation.will, **options)
+        self.assertEqual(expectation.response_code, 200)
+        self.assert_(mock.verify())
+    
+    def test_fault_reset(self):
+        """Tests resetting the connection partway through the body."""
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/index.html').will(
+            body='Test response. ' * 1000, fault='reset')
+        self.assertRaises((socket.error, httplib.HTTPException),
+                          self._raw_get, '/index.html')
+        self.assert_(mock.verify())
+    
+    def test_fault_truncate(self):
+        """Tests sending less of the body than the Content-Length says."""
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/index.html').will(
+            body='Test response.', fault='truncate')
+        try:
+            self._raw_get('/index.html')
+        except httplib.IncompleteRead, e:
+            self.assertEqual(e.partial, 'Test re')
+        else:
+            self.fail('Expected IncompleteRead')
+        self.assert_(mock.verify())
+    
+    def test_fault_stall(self):
+        """Tests a response that stops partway until the server closes."""
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/index.html').will(
+            body='Test response.', fault='stall')
+        self.assertRaises(socket.timeout, self._raw_get, '/index.html', 0.5)
+        self.assert_(mock.verify())
+    
+    def test_fault_stall_client_hangs_up(self):
+        """Tests that a stall ends, freeing its thread, once the client has
+        given up on it."""
+        mock = MockHTTP(self.server_port, threads=2)
+        mock.expects(method=GET, path='/stall.html').will(
+            body='Test response.', fault='stall')
+        mock.expects(method=GET, path='/ok.html').will(body='Test response.')
+        for i in range(2):
+            self.assertRaises(socket.timeout, self._raw_get, '/stall.html', 0.5)
+        resp, content = self._raw_get('/ok.html', 5)
+        self.assertEqual(content, 'Test response.')
+        self.assert_(mock.verify())
+    
+    def test_fault_stall_timeout(self):
+        """Tests that a stall gives up on a patient client in time."""
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/index.html').will(
+            body='Test response.', fault='stall', stall_timeout=0.3)
+        started = time.time()
+        try:
+            self._raw_get('/index.html', 5)
+        except httplib.IncompleteRead, e:
+            self.assertEqual(e.partial, 'Test re')
+        else:
+            self.fail('Expected IncompleteRead')
+        self.assert_(time.time() - started < 5)
+        self.assert_(mock.verify())
+    
+    def test_fault_trickle(self):
+        """Tests sending the headers slowly, but only as often as asked."""
+        mock = MockHTTP(self.server_port)
+        mock.expects(method=GET, path='/slow.html').will(
+            body='Test response.', fault='trickle', fault_delay=0.005)
+        mock.expects(method=GET, path='/fast.html').will(
+            body='Test response.', fault='trickle', fault_delay=0.005,
+            fault_rate=0)
+        started = time.time()
+        resp, content = self._raw_get('/slow.html')
+        self.assert_(time.time() - started >= 0.3)
+        self.assertEqual(content, 'Test response.')
+        started = time.time()
+        resp, content = self._raw_get('/fast.html')
+        self.assert_(time.time() - started < 0.3)
+        self.assert_(mock.verify())
+
+
+class TestMockHTTPPool(TestCase):
+    def setUp(self):
+        self.http = httplib2.Http()
+        self.pool = MockHTTPPool(size=1)
+    
+    def tearDown(self):
+        self.pool.close()
+        assert threading.active_count() == 1, threading.active_count()
+    
+    def test_reuse(self):
+        """Tests that a released server is reset and handed out again."""
+        mock = self.pool.acquire()
+        self.assertNotEqual(mock.port, 0)
+        mock.expects(method=GET, path='/index.html', times=once)
+        resp, content = self.http.request(
+            uri = mock.url('/index.html'), method = 'GET')
+        self.assertEqual(resp['status'], '200')
+        self.assert_(self.pool.release(mock))
+        self.assert_(self.pool.acquire() is mock)
+        resp, content = self.http.request(
+            uri = mock.url('/index.html'), method = 'GET')
+        self.assertEqual(resp['status'], '404')
+        self.assertRaises(UnexpectedURLException, self.pool.release, mock)
+    
+    def test_release_unmet_expectation(self):
+        """Tests that a server failing verification still goes back clean."""
+        mock = self.pool.acquire()
+        mock.expects(method=GET, path='/index.html', times=once)
+        self.assertRaises(UnretrievedURLException, self.pool.release, mock)
+        self.assert_(self.pool.acquire() is mock)
+        self.assert_(self.pool.release(mock))
+    
+    def test_release_removes_hooks(self):
+        """Tests that hooks added by one user of a server don't see the
+        next one's requests."""
+        phases = []
+        mock = self.pool.acquire()
+        mock.add_hook(lambda phase, timestamp, method, path:
+                      phases.append(phase))
+        self.assert_(self.pool.release(mock))
+        mock = self.pool.acquire()
+        mock.expects(method=GET, path='/index.html')
+        resp, content = self.http.request(
+            uri = mock.url('/index.html'), method = 'GET')
+        self.assertEqual(phases, [])
+        self.assert_(self.pool.release(mock))
+    
+    def test_acquire_many(self):
+        """Tests that the pool starts more servers when it runs out."""
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        self.assertNotEqual(first.port, second.port)
+    
+    def test_release_closes_connections(self):
+        """Tests that a connection kept alive by one user of a server doesn't
+        hold up the next."""
+        mock = self.pool.acquire()
+        mock.expects(method=GET, path='/index.html')
+        resp, content = self.http.request(
+            uri = mock.url('/index.html'), method = 'GET')
+        self.assert_(self.pool.release(mock))
+        mock = self.pool.acquire()
+        mock.expects(method=GET, path='/index.html')
+        started = time.time()
+        resp, content = httplib2.Http().request(
+            uri = mock.url('/index.html'), method = 'GET')
+        self.assert_(time.time() - started < 5)
+        self.assertEqual(resp['status'], '200')
+        self.assert_(self.pool.release(mock))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Copyright 2010 O'Reilly Media, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+pytest_plugins = 'pytester'
+
+def _runpytest(testdir):
+    # Load the plugin by module whether or not its entry point is installed.
+    return testdir.runpytest('-p', 'no:mock_http',
+                             '-p', 'mock_http.pytest_plugin')
+
+def test_fixtures(testdir):
+    """Tests that tests get running servers, over HTTP and HTTPS."""
+    testdir.makepyfile("""
+        import httplib2
+        from mock_http import GET, once
+        
+        def test_http(mock_http):
+            mock_http.expects(GET, '/index.html', times=once).will(body='Hi.')
+            resp, content = httplib2.Http().request(
+                mock_http.url('/index.html'))
+            assert content == 'Hi.'
+        
+        def test_https(mock_https):
+            mock_https.expects(GET, '/index.html').will(body='Hi.')
+            resp, content = httplib2.Http(ca_certs=mock_https.ca_path).request(
+                mock_https.url('/index.html'))
+            assert mock_https.url('/').startswith('https:')
+            assert content == 'Hi.'
+    """)
+    _runpytest(testdir).assert_outcomes(passed=2)
+
+def test_unmet_expectation(testdir):
+    """Tests that a server that wasn't used as expected errors the test."""
+    testdir.makepyfile("""
+        from mock_http import GET, once
+        
+        def test_unmet(mock_http):
+            mock_http.expects(GET, '/index.html', times=once)
+    """)
+    result = _runpytest(testdir)
+    result.assert_outcomes(passed=1, error=1)
+    result.stdout.fnmatch_lines(['*UnretrievedURLException*'])
+
+def test_reuse(testdir):
+    """Tests that each test gets the same server back, reset and with no
+    connections held over from the test before."""
+    testdir.makepyfile("""
+        import time
+        import httplib2
+        from mock_http import GET
+        
+        http = httplib2.Http()
+        servers = []
+        
+        def test_first(mock_http):
+            servers.append(mock_http)
+            mock_http.expects(GET, '/first.html')
+            resp, content = http.request(mock_http.url('/first.html'))
+            assert resp.status == 200
+        
+        def test_second(mock_http):
+            assert mock_http is servers[0]
+            assert mock_http.expected[GET] == {}
+            mock_http.expects(GET, '/second.html')
+            started = time.time()
+            resp, content = httplib2.Http().request(
+                mock_http.url('/second.html'))
+            assert time.time() - started < 5
+            assert resp.status == 200
+    """)
+    _runpytest(testdir).assert_outcomes(passed=2)
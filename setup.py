@@ -35,5 +35,9 @@ setup(name='mock_http',
       ],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      mock-http = mock_http.cli:main
+      [pytest11]
+      mock_http = mock_http.pytest_plugin
       """,
       )